@@ -154,7 +154,11 @@ except gdb.error:
     pass
 
 # handle resize event to align width and completion
-signal.signal(signal.SIGWINCH, lambda signum, frame: gdb.execute("set width %i" % pwndbg.ui.get_window_size()[1]))
+def _on_resize(signum, frame):
+    pwndbg.ui.get_window_size.clear()
+    gdb.execute("set width %i" % pwndbg.ui.get_window_size()[1])
+
+signal.signal(signal.SIGWINCH, _on_resize)
 
 # Workaround for gdb bug described in #321 ( https://github.com/pwndbg/pwndbg/issues/321 )
 # More info: https://sourceware.org/bugzilla/show_bug.cgi?id=21946
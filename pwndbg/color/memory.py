@@ -9,7 +9,9 @@ import six
 
 import pwndbg.color.theme as theme
 import pwndbg.config as config
+import pwndbg.memoize
 import pwndbg.vmmap
+from pwndbg.color import disable_colors
 from pwndbg.color import generateColorFunction
 from pwndbg.color import normal
 
@@ -69,6 +71,7 @@ def get(address, text = None):
 
     return color(text)
 
+@pwndbg.memoize.forever
 def legend():
     return 'LEGEND: ' + ' | '.join((
         stack('STACK'),
@@ -78,3 +81,7 @@ def legend():
         rwx('RWX'),
         rodata('RODATA')
     ))
+
+@config.Trigger([config_stack, config_heap, config_code, config_data, config_rodata, config_rwx, disable_colors])
+def reset_legend():
+    legend.clear()
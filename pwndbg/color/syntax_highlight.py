@@ -44,10 +44,12 @@ def check_style():
         style.revert_default()
 
 
-def syntax_highlight(code, filename='.asm'):
-    # No syntax highlight if pygment is not installed
-    if not pygments or disable_colors:
-        return code
+def get_lexer(filename, code):
+    """
+    Returns the (cached) lexer for the given file, guessing it from the code if needed
+    """
+    if not pygments:
+        return None
 
     filename = os.path.basename(filename)
 
@@ -73,6 +75,18 @@ def syntax_highlight(code, filename='.asm'):
     if lexer:
         lexer_cache[filename] = lexer
 
+    return lexer
+
+
+def syntax_highlight(code, filename='.asm', lexer=None):
+    # No syntax highlight if pygment is not installed
+    if not pygments or disable_colors:
+        return code
+
+    if lexer is None:
+        lexer = get_lexer(filename, code)
+
+    if lexer:
         code = pygments.highlight(code, lexer, formatter).rstrip()
 
     return code
@@ -6,11 +6,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
-import ast
+import atexit
 import codecs
 import ctypes
+import itertools
 import sys
 import os
+import re
 from io import open
 
 import gdb
@@ -57,6 +59,15 @@ config_context_sections = pwndbg.config.Parameter('context-sections',
                                                   'regs disasm code stack backtrace',
                                                   'which context sections are displayed (controls order)')
 
+splited_config_outputs = {
+    'r' : config_output_regs,
+    'd' : config_output_disasm,
+    'a' : config_output_args,
+    'c' : config_output_code,
+    's' : config_output_stack,
+    'b' : config_output_backtrace
+}
+
 @pwndbg.config.Trigger([config_context_sections])
 def validate_context_sections():
     valid_values = [context.__name__.replace('context_', '') for context in context_sections.values()]
@@ -82,22 +93,89 @@ class StdOutput(object):
     def __exit__(*args, **kwargs):
         pass
 
+output_files = {}
+
+class FileOutput(object):
+    """A context manager wrapper to give a file/tty that stays open between contexts"""
+    def __init__(self, path):
+        self.path = path
+    def __enter__(self):
+        out = output_files.get(self.path)
+        if out is not None and (out.closed or not _is_same_file(out, self.path)):
+            # The file was removed or rotated, reopen it
+            self._evict()
+            out = None
+        if out is None:
+            out = output_files[self.path] = open(self.path, "a", buffering=65536, encoding="utf-8")
+        return out
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                output_files[self.path].flush()
+                return False
+            except (IOError, OSError) as e:
+                exc_value = e
+        elif not issubclass(exc_type, (IOError, OSError)):
+            return False
+
+        # The tty went away (e.g. its pane was closed), reopen it next time
+        self._evict()
+        print(message.warn("Cannot write context to %s: %s" % (self.path, exc_value)))
+        return True
+    def _evict(self):
+        out = output_files.pop(self.path, None)
+        if out is None:
+            return
+        try:
+            out.close()
+        except (IOError, OSError):
+            pass
+
+def _is_same_file(out, path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    fst = os.fstat(out.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
 def show_context(config_output_tty, content):
+    """
+    Writes the content to the configured output. Entries are lines
+    or whole sections that already contain newlines.
+    """
     with output(config_output_tty) as out:
         if config_clear_screen:
             clear_screen(out)
 
-        for line in content:
-            out.write(line + '\n')
+        buf = '\n'.join(content)
+        if buf:
+            out.write(buf)
+            out.write('\n')
+
         out.flush()
 
 
 def output(config_output_tty):
     """Creates a context manager corresponding to configured context ouput"""
-    if not config_output_tty or config_output_tty == "stdout":
+    if _is_stdout(config_output_tty):
         return StdOutput()
     else:
-        return open(str( config_output_tty ), "w")
+        return FileOutput(str(config_output_tty))
+
+@pwndbg.config.Trigger([config_output] + list(splited_config_outputs.values()))
+def close_output_files():
+    """Closes the files/ttys that are not configured as an output anymore"""
+    in_use = set(str(param) for param in [config_output] + list(splited_config_outputs.values()))
+    for path in list(output_files):
+        if path not in in_use:
+            output_files.pop(path).close()
+
+@atexit.register
+def _close_all_output_files():
+    for out in output_files.values():
+        out.close()
+    output_files.clear()
 
 # @pwndbg.events.stop
 
@@ -121,46 +199,55 @@ def context(subcontext=None):
 
     args = [a[0] for a in args]
 
-    splited_config_outputs = {
-        'r' : config_output_regs,
-        'd' : config_output_disasm,
-        'a' : config_output_args,
-        'c' : config_output_code,
-        's' : config_output_stack,
-        'b' : config_output_backtrace
-    }
-
     splited_output_queue = {}
-
-    tmp_args = args.copy()
-    for tmp_arg in tmp_args:
-        if splited_config_outputs[tmp_arg] != 'nosplit':
-            func = context_sections.get(tmp_arg, None)
-            if func:
-                tty_key = str(splited_config_outputs[tmp_arg])
-                if tty_key not in splited_output_queue:
-                    splited_output_queue[tty_key] = []
-                splited_output_queue[tty_key].extend(func())
-                args.remove(tmp_arg)
-
-    result = [M.legend()] if args else []
+    inline = []
 
     for arg in args:
         func = context_sections.get(arg, None)
-        if func:
-            result.extend(func())
+        if not func:
+            continue
+
+        tty_key = str(splited_config_outputs[arg])
+        if tty_key == 'nosplit':
+            inline.append(func)
+        else:
+            splited_output_queue.setdefault(tty_key, []).append(func)
+
+    result = [M.legend()] if inline else []
 
-    current_tty = os.ttyname(1)
+    for func in inline:
+        result.extend(func())
+
+    current_tty = _current_tty()
     if current_tty in splited_output_queue:
-        result.extend(splited_output_queue[current_tty])
-        del splited_output_queue[current_tty]
+        for func in splited_output_queue.pop(current_tty):
+            result.extend(func())
     if len(result) > 0:
         result.append(pwndbg.ui.banner(""))
-    result.extend(context_signal())
+    if last_signal:
+        result.extend(context_signal())
 
     show_context(config_output, result)
-    for tty, content in splited_output_queue.items():
-        show_context(tty, content)
+    for tty, funcs in splited_output_queue.items():
+        # Don't render sections nobody can see
+        if not _is_stdout(tty) and not _is_writable(tty):
+            print(message.warn("Cannot write context to %s" % tty))
+            continue
+
+        # Each section is joined once, show_context only has to join the sections
+        sections = (func() for func in funcs)
+        show_context(tty, ['\n'.join(section) for section in sections if section])
+
+def _is_stdout(config_output_tty):
+    return not config_output_tty or config_output_tty == "stdout"
+
+def _is_writable(path):
+    """
+    Checks whether the given file/tty exists and is writable or can be created
+    """
+    if os.path.exists(path):
+        return os.access(path, os.W_OK)
+    return os.access(os.path.dirname(os.path.abspath(path)), os.W_OK)
 
 def context_regs():
     return [pwndbg.ui.banner("registers")] + get_regs()
@@ -189,7 +276,18 @@ def get_regs(*regs):
     if pwndbg.config.show_flags:
         regs += tuple(pwndbg.regs.flags)
 
-    changed = pwndbg.regs.changed
+    # Register reads are memoized until the next stop/prompt and are already
+    # primed by pwndbg.regs.update_last on every stop
+    changed = set(pwndbg.regs.changed)
+
+    # Registers often share values (zeroes, pointers into the same frame),
+    # so each distinct value only gets its chain walked once
+    chains = {}
+
+    change_marker = "%s" % C.config_register_changed_marker
+    unchanged_marker = ' ' * len(change_marker)
+    flags = pwndbg.regs.flags
+    last = pwndbg.regs.last
 
     for reg in regs:
         if reg is None:
@@ -202,36 +300,87 @@ def get_regs(*regs):
         value = pwndbg.regs[reg]
 
         # Make the register stand out
-        regname = C.register(reg.ljust(4).upper())
+        regname = _register_label(reg)
 
         # Show a dot next to the register if it changed
-        change_marker = "%s" % C.config_register_changed_marker
-        m = ' ' * len(change_marker) if reg not in changed else C.register_changed(change_marker)
+        m = unchanged_marker if reg not in changed else C.register_changed(change_marker)
 
-        if reg in pwndbg.regs.flags:
-            desc = C.format_flags(value, pwndbg.regs.flags[reg], pwndbg.regs.last.get(reg, 0))
+        if reg in flags:
+            desc = C.format_flags(value, flags[reg], last.get(reg, 0))
 
         else:
-            desc = pwndbg.chain.format(value)
+            if value not in chains:
+                chains[value] = pwndbg.chain.format(value)
+            desc = chains[value]
 
         result.append("%s%s %s" % (m, regname, desc))
 
     return result
 
+@pwndbg.memoize.forever
+def _register_label(reg):
+    # Labels only depend on the register name and its color
+    return C.register(reg.ljust(4).upper())
+
+@pwndbg.config.Trigger([C.config_register_color, pwndbg.color.disable_colors])
+def _reset_register_labels():
+    _register_label.clear()
+
 pwndbg.config.Parameter('emulate', True, '''
 Unicorn emulation of code near the current instruction
 ''')
 code_lines = pwndbg.config.Parameter('context-code-lines', 10, 'number of additional lines to print in the code context')
+emulate_when = pwndbg.config.Parameter('context-emulate-when', 'always',
+                                       'when disasm-context should emulate ("always", "interactive" - only when output goes to a tty, or "never")')
+
+@pwndbg.config.Trigger([emulate_when])
+def validate_emulate_when():
+    valid_values = ['always', 'interactive', 'never']
+    if emulate_when not in valid_values:
+        print(message.warn('Invalid value: %s, must be one of: %s' % (emulate_when, ', '.join(valid_values))))
+        emulate_when.revert_default()
+
+def _disasm_goes_to_tty():
+    """
+    Checks whether disasm-context is written to a terminal someone can watch
+    """
+    target = str(config_output_disasm)
+    if target == 'nosplit':
+        target = str(config_output)
+
+    if _is_stdout(target):
+        return bool(_current_tty())
+
+    out = output_files.get(target)
+    if out is not None and not out.closed:
+        return out.isatty()
+
+    # Not opened yet; don't create files or block on FIFOs just to check
+    try:
+        fd = os.open(target, os.O_WRONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        return os.isatty(fd)
+    finally:
+        os.close(fd)
 
 def context_disasm():
     banner = [pwndbg.ui.banner("disasm")]
     emulate = bool(pwndbg.config.emulate)
-    result = pwndbg.commands.nearpc.nearpc(to_string=True, emulate=emulate, lines=code_lines // 2)
+
+    # Emulation is the most expensive part of the context, skip it when nobody is looking
+    if emulate_when == 'never' or (emulate_when == 'interactive' and not _disasm_goes_to_tty()):
+        emulate = False
+
+    lines = int(code_lines)
+    result = pwndbg.commands.nearpc.nearpc(to_string=True, emulate=emulate, lines=lines // 2)
 
     # If we didn't disassemble backward, try to make sure
     # that the amount of screen space taken is roughly constant.
-    while len(result) < code_lines + 1:
-        result.append('')
+    padding = lines + 1 - len(result)
+    if padding > 0:
+        result += [''] * padding
 
     return banner + result
 
@@ -241,18 +390,68 @@ source_code_lines = pwndbg.config.Parameter('context-source-code-lines',
                                              'number of source code lines to print by the context command')
 theme.Parameter('code-prefix', '►', "prefix marker for 'context code' command")
 
+_trailing_whitespace = re.compile(r'[^\S\n]+$', re.MULTILINE)
+
+def _read_source(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size <= 0x10000:
+            with open(fd, encoding='utf-8', closefd=False) as f:
+                return f.read()
+
+        # Big files are read with as few syscalls as possible, bypassing the buffered reader
+        chunks = []
+        while True:
+            chunk = os.read(fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        # Translate newlines the way the text reader does
+        source = b''.join(chunks).decode('utf-8')
+        return source.replace('\r\n', '\n').replace('\r', '\n')
+    finally:
+        os.close(fd)
+
 @pwndbg.memoize.reset_on_start
-def get_highlight_source(filename):
+def _get_raw_source(filename):
     # Notice that the code is cached
-    with open(filename, encoding='utf-8') as f:
-        source = f.read()
+    source = _read_source(filename)
+
+    source = _trailing_whitespace.sub('', source)
+    return tuple(source.splitlines())
+
+@pwndbg.memoize.reset_on_start
+def _get_lexer(filename):
+    # The language is guessed from the whole file, a few lines aren't enough
+    return H.get_lexer(filename, '\n'.join(_get_raw_source(filename)))
 
-    if pwndbg.config.syntax_highlight:
-        source = H.syntax_highlight(source, filename)
+@pwndbg.memoize.reset_on_start
+def get_highlight_source(filename, start, end):
+    """
+    Returns lines [start, end) of the given file, highlighted if enabled.
+    Nothing after the displayed window is highlighted.
+    """
+    source = _get_raw_source(filename)
+
+    if not pwndbg.config.syntax_highlight:
+        return source[start:end]
 
-    source_lines = source.splitlines()
-    source_lines = tuple(line.rstrip() for line in source_lines)
-    return source_lines
+    # Highlight from the start of the file, so that the window is lexed in the right
+    # state (e.g. when it begins inside a multi-line comment)
+    source = source[:end]
+    highlighted = H.syntax_highlight('\n'.join(source), filename, lexer=_get_lexer(filename))
+    highlighted = _trailing_whitespace.sub('', highlighted).splitlines()
+
+    # Lexers may strip blank lines at both ends, restore them to keep lines aligned
+    trailing = len(source) - len(tuple(itertools.dropwhile(lambda line: not line, reversed(source))))
+    while highlighted and not highlighted[-1]:
+        highlighted.pop()
+    highlighted += [''] * trailing
+    highlighted = [''] * (len(source) - len(highlighted)) + highlighted
+
+    return tuple(highlighted[len(highlighted) - (end - start):])
 
 def get_filename_and_formatted_source():
     """
@@ -270,8 +469,8 @@ def get_filename_and_formatted_source():
     filename = sal.symtab.fullname()
 
     try:
-        source = get_highlight_source(filename)
-    except IOError:
+        source = _get_raw_source(filename)
+    except (IOError, OSError):
         return '', []
 
     if not source:
@@ -284,27 +483,23 @@ def get_filename_and_formatted_source():
     end = min(closest_line - 1 + n//2 + 1, len(source))
     num_width = len(str(end))
 
-    # split the code
-    source = source[start:end]
+    # split and highlight the code
+    source = get_highlight_source(filename, start, end)
 
     # Compute the prefix_sign length
-    prefix_sign = pwndbg.config.code_prefix
+    prefix_sign = str(pwndbg.config.code_prefix)
     prefix_width = len(prefix_sign)
+    prefix_colored = C.prefix(prefix_sign)
+    highlight_source = bool(pwndbg.config.highlight_source)
 
-    # Format the output
+    # Format the output; only the line number and code vary between lines
+    fmt = ' {prefix_sign:%d} {line_number:>%d} {code}' % (prefix_width, num_width)
     formatted_source = []
     for line_number, code in enumerate(source, start=start + 1):
-        fmt = ' {prefix_sign:{prefix_width}} {line_number:>{num_width}} {code}'
-        if pwndbg.config.highlight_source and line_number == closest_line:
-            fmt = C.highlight(fmt)
-
-        line = fmt.format(
-            prefix_sign=C.prefix(prefix_sign) if line_number == closest_line else '',
-            prefix_width=prefix_width,
-            line_number=line_number,
-            num_width=num_width,
-            code=code
-        )
+        is_closest = line_number == closest_line
+        line = fmt.format(prefix_sign=prefix_colored if is_closest else '', line_number=line_number, code=code)
+        if highlight_source and is_closest:
+            line = C.highlight(line)
         formatted_source.append(line)
 
     return filename, formatted_source
@@ -352,46 +547,44 @@ def context_backtrace(frame_count=10, with_banner=True):
     if with_banner:
         result.append(pwndbg.ui.banner("backtrace"))
 
-    this_frame    = gdb.selected_frame()
-    newest_frame  = this_frame
-    oldest_frame  = this_frame
+    this_frame = gdb.selected_frame()
 
+    # Walk each direction once, remembering the frames we went through
+    older_frames = []
+    frame = this_frame
     for i in range(frame_count):
         try:
-            candidate = oldest_frame.older()
+            frame = frame.older()
         except gdb.MemoryError:
             break
 
-        if not candidate:
+        if not frame:
             break
-        oldest_frame = candidate
+        older_frames.append(frame)
 
+    newer_frames = []
+    frame = this_frame
     for i in range(frame_count):
-        candidate = newest_frame.newer()
-        if not candidate:
+        frame = frame.newer()
+        if not frame:
             break
-        newest_frame = candidate
+        newer_frames.append(frame)
 
-    frame = newest_frame
-    i     = 0
-    bt_prefix = "%s" % B.config_prefix
-    while True:
+    frames = newer_frames[::-1] + [this_frame] + older_frames
 
-        prefix = bt_prefix if frame == this_frame else ' ' * len(bt_prefix)
-        prefix = " %s" % B.prefix(prefix)
-        addrsz = B.address(pwndbg.ui.addrsz(frame.pc()))
-        symbol = B.symbol(pwndbg.symbol.get(frame.pc()))
+    bt_prefix = "%s" % B.config_prefix
+    this_prefix  = " %s" % B.prefix(bt_prefix)
+    other_prefix = " %s" % B.prefix(' ' * len(bt_prefix))
+    for i, frame in enumerate(frames):
+        prefix = this_prefix if frame == this_frame else other_prefix
+        frame_pc = frame.pc()
+        addrsz = B.address(pwndbg.ui.addrsz(frame_pc))
+        symbol = B.symbol(pwndbg.symbol.get(frame_pc))
         if symbol:
             addrsz = addrsz + ' ' + symbol
-        line   = map(str, (prefix, B.frame_label('%s%i' % (backtrace_frame_label, i)), addrsz))
-        line   = ' '.join(line)
+        line   = '%s %s %s' % (prefix, B.frame_label('%s%i' % (backtrace_frame_label, i)), addrsz)
         result.append(line)
 
-        if frame == oldest_frame:
-            break
-
-        frame = frame.older()
-        i    += 1
     return result
 
 
@@ -460,15 +653,26 @@ context_sections = {
 }
 
 
+@pwndbg.memoize.forever
+def _current_tty():
+    """
+    Returns the tty gdb's stdout is attached to, or an empty string if it is redirected
+    """
+    try:
+        return os.ttyname(1)
+    except OSError:
+        return ''
+
+
 @pwndbg.memoize.forever
 def _is_rr_present():
     """
     Checks whether rr project is present (so someone launched e.g. `rr replay <some-recording>`)
     """
 
-    # this is ugly but I couldn't find a better way to do it
-    # feel free to refactor it
-    globals_list_literal_str = gdb.execute('python print(list(globals().keys()))', to_string=True)
-    interpreter_globals = ast.literal_eval(globals_list_literal_str)
+    # rr defines its commands in the globals of gdb's python interpreter,
+    # which is the __main__ module of the interpreter we are running in
+    import __main__
+    interpreter_globals = vars(__main__)
 
     return 'RRCmd' in interpreter_globals and 'RRWhere' in interpreter_globals
@@ -16,6 +16,7 @@ import termios
 
 import pwndbg.arch
 import pwndbg.color.context as C
+import pwndbg.memoize
 from pwndbg import config
 from pwndbg.color import ljust_colored
 from pwndbg.color import message
@@ -56,7 +57,10 @@ def addrsz(address):
     address = int(address) & pwndbg.arch.ptrmask
     return "%{}x".format(2*pwndbg.arch.ptrsize) % address
 
+@pwndbg.memoize.reset_on_stop
 def get_window_size():
+    # Also cleared by the SIGWINCH handler in pwndbg/__init__.py. gdb doesn't get
+    # that signal while the inferior runs in the foreground, hence the reset on stop.
     fallback = (int(os.environ.get('LINES', 20)), int(os.environ.get('COLUMNS', 80)))
     if not sys.stdin.isatty:
         return fallback